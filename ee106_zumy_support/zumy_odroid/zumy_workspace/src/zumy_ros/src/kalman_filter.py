@@ -1,14 +1,165 @@
 #!/usr/bin/env python
+from __future__ import print_function, division
 import rospy
 import numpy as np
-from numpy.linalg import inv
+import math
+import logging
+import os
+import ctypes
+import ctypes.util
 import sys
+import threading
 from geometry_msgs.msg import Transform,TransformStamped
 from zumy_ros.srv import ImuSrv,ImuSrvResponse,NuSrv,NuSrvResponse
 from tf2_msgs.msg import TFMessage
 from std_msgs.msg import String,Header,Int32,Float32,Bool
 
-class KalmanFilter:
+try:
+  from numba import njit
+except ImportError:
+  # numba is optional: without it the update kernels below simply run as NumPy code
+  def njit(*args, **kwargs):
+    return lambda f: f
+
+# The filter math lives in these module level kernels (rather than in KalmanFilter) so
+# numba can compile them. Arrays are updated in place and the scalar states are returned.
+# The small products are written out as scalars: numba's np.dot/np.linalg need SciPy.
+# The translational state is kept as one vector xv = [x, vx, y, vy].
+
+# Add qr*[[g00,g01],[g01,g11]] to the 2x2 block of P_lin starting at (i,j)
+@njit(cache=True, fastmath=True)
+def _add_noise_block(P_lin, i, j, qr, g00, g01, g11):
+  P_lin[i,j] += qr*g00
+  P_lin[i,j+1] += qr*g01
+  P_lin[i+1,j] += qr*g01
+  P_lin[i+1,j+1] += qr*g11
+
+# Time update: propagate the state and its uncertainty using the IMU input
+@njit(cache=True, fastmath=True)
+def _time_update(xv, psi, P_lin, P_ang, u_lin, u_ang, dt, Q_acc, Q_ang):
+  # Determine orientation (rot = [[c,-s],[s,c]])
+  c = math.cos(psi)
+  s = math.sin(psi)
+  # Propagate dynamics
+  ax = c*u_lin[0] - s*u_lin[1]
+  ay = s*u_lin[0] + c*u_lin[1]
+  xv[0] += xv[1]*dt + 0.5*ax*dt*dt
+  xv[2] += xv[3]*dt + 0.5*ay*dt*dt
+  xv[1] += ax*dt
+  xv[3] += ay*dt
+  psi += u_ang*dt
+  # Update uncertainty
+  # A_lin*P_lin*A_lin^T written out: A_lin is two [[1,dt],[0,1]] blocks, so it only adds
+  # dt times each velocity row (then column) onto the matching position row (column)
+  P_lin[0,:] += dt*P_lin[1,:]
+  P_lin[2,:] += dt*P_lin[3,:]
+  P_lin[:,0] += dt*P_lin[:,1]
+  P_lin[:,2] += dt*P_lin[:,3]
+  # rotxv*Q_lin*rotxv^T with rotxv = kron(rot,eye(2)) and Q_lin = G_lin*Q_acc*G_lin^T:
+  # block (a,b) of the result is (rot*Q_acc*rot^T)[a,b] * g*g^T, where g = [dt^2/2, dt]
+  qxx = Q_acc[0,0]
+  qxy = Q_acc[0,1]
+  qyy = Q_acc[1,1]
+  cc = c*c
+  ss = s*s
+  cs = c*s
+  qr00 = cc*qxx - 2.*cs*qxy + ss*qyy
+  qr01 = cs*(qxx - qyy) + (cc - ss)*qxy
+  qr11 = ss*qxx + 2.*cs*qxy + cc*qyy
+  dt2 = dt*dt
+  g00 = 0.25*dt2*dt2
+  g01 = 0.5*dt2*dt
+  _add_noise_block(P_lin, 0, 0, qr00, g00, g01, dt2)
+  _add_noise_block(P_lin, 0, 2, qr01, g00, g01, dt2)
+  _add_noise_block(P_lin, 2, 0, qr01, g00, g01, dt2)
+  _add_noise_block(P_lin, 2, 2, qr11, g00, g01, dt2)
+  P_ang += Q_ang
+  return psi, P_ang
+
+# Measurement update: correct the state with a camera fix (z_lin) and heading innovation (e_ang)
+@njit(cache=True, fastmath=True)
+def _measurement_update(xv, psi, P_lin, P_ang, z_lin, e_ang, R_lin, R_ang):
+  # (R_lin is the per-axis camera position variance: the full matrix is R_lin*eye(2))
+  # Compute innovation
+  ex = z_lin[0] - xv[0]
+  ey = z_lin[1] - xv[2]
+  # C_lin selects the position states 0 and 2 (and C_ang = 1), so C*P*C^T and P*C^T
+  # are just slices of P; S_lin = [[a,b],[c,d]] is kept as scalars
+  a = P_lin[0,0] + R_lin
+  b = P_lin[0,2]
+  c = P_lin[2,0]
+  d = P_lin[2,2] + R_lin
+  S_ang = P_ang + R_ang
+  # Compute Kalman gain
+  # S_lin is 2x2, so K = P C^T inv(S) uses the closed-form inverse [[d,-b],[-c,a]]/det
+  # (P_lin is PSD, so det >= R_lin^2 > 0)
+  det = a*d - b*c
+  K_lin = np.empty((4,2))
+  for i in range(4):
+    p0 = P_lin[i,0]
+    p2 = P_lin[i,2]
+    K_lin[i,0] = (p0*d - p2*c)/det
+    K_lin[i,1] = (p2*a - p0*b)/det
+  K_ang = P_ang/S_ang
+  # Update state
+  for i in range(4):
+    xv[i] += K_lin[i,0]*ex + K_lin[i,1]*ey
+  psi += K_ang*e_ang
+  # Update uncertainty
+  # Symmetric form P -= K*S*K^T, computed on the upper triangle and mirrored so P_lin
+  # stays exactly symmetric (no 4x4 temporaries)
+  for i in range(4):
+    ks0 = K_lin[i,0]*a + K_lin[i,1]*c
+    ks1 = K_lin[i,0]*b + K_lin[i,1]*d
+    for j in range(i,4):
+      pij = P_lin[i,j] - (ks0*K_lin[j,0] + ks1*K_lin[j,1])
+      P_lin[i,j] = pij
+      P_lin[j,i] = pij
+  return psi
+
+# Run both kernels once on dummy data of the real types, so numba compiles them (or loads
+# them from its cache) before the 10 Hz loop rather than stalling its first cycle
+def _warm_up_kernels():
+  P_lin = np.eye(4)
+  psi, P_ang = _time_update(np.zeros(4), 0., P_lin, 1., np.zeros(2), 0., 0.1, np.eye(2), 0.)
+  _measurement_update(np.zeros(4), psi, P_lin, P_ang, np.zeros(2), 0., 1., 1.)
+
+# Per-thread CPU affinity and SCHED_FIFO priority. Python 3 has these as os.sched_*; on
+# Python 2 the same libc calls are made through ctypes.
+_SCHED_FIFO = 1
+_libc = None
+
+def _call_libc(name, *args):
+  global _libc
+  if _libc is None:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+  if getattr(_libc, name)(*args) != 0:
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+
+def _set_affinity(tid, cpu):
+  if hasattr(os, 'sched_setaffinity'):
+    os.sched_setaffinity(tid, [cpu])
+  else:
+    # cpu_set_t is a 1024 bit mask
+    bits = 8*ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong*(1024//bits))()
+    mask[cpu//bits] = 1 << (cpu % bits)
+    _call_libc('sched_setaffinity', tid, ctypes.sizeof(mask), ctypes.byref(mask))
+
+def _set_fifo(tid, priority):
+  if hasattr(os, 'sched_setscheduler'):
+    os.sched_setscheduler(tid, os.SCHED_FIFO, os.sched_param(priority))
+  else:
+    param = ctypes.c_int(priority) # struct sched_param { int sched_priority; }
+    _call_libc('sched_setscheduler', tid, _SCHED_FIFO, ctypes.byref(param))
+
+# Heading of a quaternion rotating about the vertical axis (w clamped against rounding).
+# The sign of z keeps sign(0) == 0, so the all-zero default Transform() gives heading 0.
+def _heading(q):
+  return 2.*math.acos(max(-1., min(1., q.w))) * ((q.z > 0) - (q.z < 0))
+
+class KalmanFilter(object):
   def __init__(self,mname):
 
     #Initialize the node
@@ -21,15 +172,16 @@ class KalmanFilter:
     self.initial_orientation_uncertainty = 0.3 # radians (0.3rad ~ 15deg)
     self.camera_position_error = 0.05 # meters
     self.camera_orientation_error = 0.1 # radians (0.1rad ~ 5deg)
-    self.C_lin = np.array([[1.,0.,0.,0.],[0.,0.,1.,0]]) # position camera measurement
-    self.C_ang = 1. # orientation camera measurement
-    self.G_lin = np.array([[0.5*pow(self.dt,2),self.dt,0.,0.],
-                          [0.,0.,0.5*pow(self.dt,2),self.dt]]).T # position IMU input
+    # Filter model (written out by hand in _time_update/_measurement_update), state xv = [x,vx,y,vy]:
+    #   translation dynamics   A_lin = [[1,dt,0,0],[0,1,0,0],[0,0,1,dt],[0,0,0,1]]
+    #   position IMU input     G_lin = [[dt^2/2,dt,0,0],[0,0,dt^2/2,dt]]^T
+    #   position camera meas.  C_lin = [[1,0,0,0],[0,0,1,0]]
+    #   rotation: A_ang = 1, G_ang = dt, C_ang = 1
     self.G_ang = self.dt # orientation IMU input
-    self.A_lin = np.array([[1.,self.dt,0.,0.],[0.,1.,0.,0.],[0.,0.,1.,self.dt],[0.,0.,0.,1.]]) # translation dynamics
-    self.A_ang = 1. # rotation dynamics
+    self.bias_delta = np.empty(2) # accelerometer sample scratch for updateAccelBias
     self.updateFlag = True
     self.mname = mname
+    _warm_up_kernels()
 
     # Measurement initialization -- only necessary temporarily while AR does not work
     self.u = None
@@ -40,15 +192,100 @@ class KalmanFilter:
  
     #Create a publisher to the state estimation topic
     # self.done_calibration_pub = rospy.Publisher('/' + mname + '/done_calibration', Bool, queue_size=2)
-    self.state_pub = rospy.Publisher('/' + mname + '/state_estimate', Transform,queue_size=2)
-    self.state_pub_tf = rospy.Publisher('/tf', TFMessage,queue_size=2)
-    self.psi_pub = rospy.Publisher("/" + mname + "/psi", Float32, queue_size=2)
+    # (queue_size=1: only the latest estimate is worth sending, stale ones are dropped)
+    self.state_pub = rospy.Publisher('/' + mname + '/state_estimate', Transform,queue_size=1)
+    self.state_pub_tf = rospy.Publisher('/tf', TFMessage,queue_size=1)
+    self.psi_pub = rospy.Publisher("/" + mname + "/psi", Float32, queue_size=1)
+
+    # Output messages are allocated once and refilled every cycle (publish serializes them
+    # immediately, so reusing them is safe)
+    self.state_msg = Transform()
+    self.tf_msg = TFMessage()
+    self.tf_msg.transforms = [TransformStamped()]
+    self.tf_msg.transforms[0].child_frame_id = mname
+    self.tf_msg.transforms[0].transform = self.state_msg
+    self.psi_msg = Float32()
 
     self.calibrate_sub = rospy.Subscriber("/"+ mname +"/calibrate", Float32, self.calibrateCallback)
 
     #Create the service for the AR tag client
     rospy.Service('innovation', NuSrv, self.triggerUpdate)
 
+    # Real-time scheduling (before starting the poll thread so it inherits the settings)
+    self.setRealtime(rospy.get_param('~rt_priority', 0), rospy.get_param('~cpu', -1))
+
+    # IMU double buffer: the poll thread writes imu_buf[imu_idx] and then flips imu_idx,
+    # so imu_buf[1-imu_idx] always holds the freshest complete sample
+    self.imu_buf = [None, None]
+    self.imu_idx = 0
+    self.imu_lock = threading.Lock()
+    imu_thread = threading.Thread(target=self.pollImu)
+    imu_thread.daemon = True
+    imu_thread.start()
+
+  # Position and velocity views of the translational state xv
+  @property
+  def x_lin(self):
+    return self.xv[[0,2]]
+
+  @property
+  def v_lin(self):
+    return self.xv[[1,3]]
+
+  # Optionally pin the node to one CPU and run it under SCHED_FIFO at the given priority
+  # (1-99) to keep the loop period steady on a loaded board; 0 / -1 leave the defaults.
+  # On Linux both calls act on a single thread, so they are applied to every thread
+  # already running (the rospy ones started by init_node, the publishers and services);
+  # threads started afterwards, like the IMU poll thread, inherit the settings.
+  # SCHED_FIFO needs root or CAP_SYS_NICE (e.g. setcap cap_sys_nice+ep on the python
+  # binary, or an rtprio limit in /etc/security/limits.conf); otherwise this only warns.
+  def setRealtime(self, priority, cpu):
+    if cpu < 0 and priority <= 0:
+      return
+    for tid in os.listdir('/proc/self/task'):
+      tid = int(tid)
+      try:
+        if cpu >= 0:
+          _set_affinity(tid, cpu)
+        if priority > 0:
+          _set_fifo(tid, priority)
+      except OSError as e:
+        rospy.logwarn("Could not set CPU %d / SCHED_FIFO priority %d for thread %d: %s"
+                      % (cpu, priority, tid, e))
+
+  # Background loop polling the IMU server (at twice the filter rate) so the filter loop
+  # and calibration never block on the service call; it is the only caller of last_imu,
+  # which hands each sample out once. The persistent connection is kept across ordinary
+  # misses and only recreated after a transport or unexpected error.
+  def pollImu(self):
+    rate = rospy.Rate(2*self.hertz)
+    get_imu = None
+    while not rospy.is_shutdown():
+      try:
+        if get_imu is None:
+          rospy.wait_for_service('last_imu')
+          get_imu = rospy.ServiceProxy('last_imu', ImuSrv, persistent=True)
+        u = get_imu()
+        with self.imu_lock:
+          self.imu_buf[self.imu_idx] = u
+          self.imu_idx = 1 - self.imu_idx
+      except rospy.ServiceException:
+        pass # no new sample since the last call
+      except Exception as e:
+        rospy.logwarn_throttle(1.0, "Service call to IMU Server failed: %s" % e)
+        if get_imu is not None:
+          get_imu.close()
+          get_imu = None
+      try:
+        rate.sleep()
+      except rospy.ROSInterruptException:
+        break
+
+  # Latest IMU sample from the poll thread (None until the first one arrives)
+  def latestImu(self):
+    with self.imu_lock:
+      return self.imu_buf[1 - self.imu_idx]
+
   def calibrateCallback(self, message):
     self.needs_to_calibrate = True
 
@@ -57,46 +294,25 @@ class KalmanFilter:
     # Define inputs
     u_lin = np.array([u.linear_acceleration_filtered.x,u.linear_acceleration_filtered.y]) - self.acc_bias
     u_ang = u.angular_velocity_filtered.z - self.gyro_bias
-    # Determine orientation
-    rot = np.array([[np.cos(self.psi),-np.sin(self.psi)],[np.sin(self.psi),np.cos(self.psi)]])
-    rotxv = np.kron(rot,np.eye(2))
-    # Propagate dynamics
-    self.x_lin += self.v_lin*self.dt + 0.5*rot.dot(u_lin)*pow(self.dt,2)
-    self.v_lin += rot.dot(u_lin)*self.dt
-    self.psi += u_ang*self.dt
-    # Update uncertainty
-    self.P_lin = self.A_lin.dot(self.P_lin).dot(self.A_lin.T)  \
-                 + rotxv.dot(self.Q_lin).dot(rotxv.T)
-    self.P_ang += self.Q_ang
- 
+    self.psi, self.P_ang = _time_update(self.xv, self.psi, self.P_lin, self.P_ang,
+                                        u_lin, u_ang, self.dt, self.Q_acc, self.Q_ang)
+
 
   # Compute a measurement update based on the received information
   def measurementUpdate(self,z):
-    # Compute innovation
-    e_lin = np.array([z.translation.x, z.translation.y]) - self.x_lin
-    # Convert angular states to (-2pi, +2pi)
-    e_ang = 2. * np.arccos(z.rotation.w) * np.sign(z.rotation.z) \
-            - (np.mod(self.psi, np.sign(self.psi)*2*np.pi))
-    S_lin  = self.C_lin.dot(self.P_lin).dot(self.C_lin.T) + self.R_lin
-    S_ang  = self.C_ang*self.P_ang*self.C_ang + self.R_ang
-    # Compute Kalman gain
-    K_lin = self.P_lin.dot(self.C_lin.T).dot(inv(S_lin))
-    K_ang = self.P_ang*self.C_ang/S_ang
-    # Update state
-    xv = np.array([self.x_lin[0],self.v_lin[0],self.x_lin[1],self.v_lin[1]])
-    xv += K_lin.dot(e_lin)
-    self.x_lin = np.array([xv[0],xv[2]])
-    self.v_lin = np.array([xv[1],xv[3]]) # np.array([0,0]) # 
-    self.psi += K_ang*e_ang
-    # Update uncertainty
-    self.P_lin = (np.eye(4)-K_lin.dot(self.C_lin)).dot(self.P_lin)
+    z_lin = np.array([z.translation.x, z.translation.y])
+    # Heading from the quaternion (vertical rotation axis), innovation wrapped to [-pi, pi)
+    psi_meas = _heading(z.rotation)
+    e_ang = (psi_meas - self.psi + math.pi) % (2*math.pi) - math.pi
+    self.psi = _measurement_update(self.xv, self.psi, self.P_lin, self.P_ang,
+                                   z_lin, e_ang, self.R_lin, self.R_ang)
     # Reset flag
     self.updateFlag = False
 
 
   # When another node calls the service sending a measurement, incorporate it
   def triggerUpdate(self,request):
-    print "updating..."
+    rospy.loginfo_throttle(1.0, "updating...")
     self.z = request.transform
     self.z_position = request.transform.translation.z
     self.origin_tag = request.origin_tag
@@ -107,42 +323,54 @@ class KalmanFilter:
   # Calibrate sensors to determine bias and variance
   def calibrateSensors(self):
     startCal = rospy.get_rostime() # node time in seconds
-    print "Starting sensor calibration..."
+    print("Starting sensor calibration...")
     m = np.empty([6,int(self.hertz*self.calTime)])
     j = 0
+    last_u = self.u # samples are taken from the poll thread's buffer, only when new
     while j < m.shape[1]:
-        rospy.wait_for_service('last_imu')
-        try:
-            get_imu = rospy.ServiceProxy('last_imu', ImuSrv)
-            u = get_imu()
-            m[:,j] = [u.linear_acceleration_filtered.x,u.linear_acceleration_filtered.y,u.linear_acceleration_filtered.z,
-                      u.angular_velocity_filtered.x, u.angular_velocity_filtered.y, u.angular_velocity_filtered.z]
+        u = self.latestImu()
+        if u is not None and u is not last_u:
+            last_u = u
+            # Write the sample straight into its column (no temporary list)
+            mv = m[:,j]
+            mv[0] = u.linear_acceleration_filtered.x
+            mv[1] = u.linear_acceleration_filtered.y
+            mv[2] = u.linear_acceleration_filtered.z
+            mv[3] = u.angular_velocity_filtered.x
+            mv[4] = u.angular_velocity_filtered.y
+            mv[5] = u.angular_velocity_filtered.z
             j = j + 1
-        except rospy.ServiceException, e:
-            #print "Service call to IMU Server failed: %s"%e
-            print "No IMU update this time step: " + str(j) + ", trying again."
-            m[:,j] = np.zeros(6)
+        else:
+            rospy.logwarn_throttle(1.0, "No IMU update this time step: " + str(j) + ", trying again.")
         self.rate.sleep()
+    self.u = last_u # already used for calibration, so run() does not count it as new
     endCal = rospy.get_rostime()
-    print "Calibration complete. Took %f seconds"%(endCal-startCal).to_sec()
-    Q = np.cov(m,bias=1)
-    mu = np.mean(m,axis=1)
-    print "Average accelerometer measurement: [%f, %f, %f]"%(mu[0], mu[1], mu[2])
-    print "Accelerometer covariance matrix:"
-    print Q[:3,:3]
-    print "Average gyroscope measurement: [%f, %f, %f]"%(mu[3], mu[4], mu[5])
-    print "Gyroscope covariance matrix:"
-    print Q[3:,3:]
+    print("Calibration complete. Took %f seconds"%(endCal-startCal).to_sec())
+    Q = np.cov(m,bias=True)
+    mu = np.empty(6)
+    m.mean(axis=1,out=mu)
+    print("Average accelerometer measurement: [%f, %f, %f]"%(mu[0], mu[1], mu[2]))
+    print("Accelerometer covariance matrix:")
+    print(Q[:3,:3])
+    print("Average gyroscope measurement: [%f, %f, %f]"%(mu[3], mu[4], mu[5]))
+    print("Gyroscope covariance matrix:")
+    print(Q[3:,3:])
     return (Q,mu)
 
   # Update accelerometer bias estimates (assumes the zumy is generally near zero acceleration)
   # (this function serves as a low-pass filter to estimate gravity and accelerometer errors)
   def updateAccelBias(self):
     alpha = 0.8 # between 0 and 1 (set to 0 to ignore accelerometer measurements)
-    bias_delta = np.array([self.u.linear_acceleration_filtered.x,
-                           self.u.linear_acceleration_filtered.y])
-    self.acc_bias = (alpha) * self.acc_bias + (1-alpha) * bias_delta
-    print 'bias:\n' + str(self.acc_bias)
+    bias_delta = self.bias_delta # preallocated scratch, filled in place
+    bias_delta[0] = self.u.linear_acceleration_filtered.x
+    bias_delta[1] = self.u.linear_acceleration_filtered.y
+    bias_delta *= (1-alpha)
+    self.acc_bias *= alpha
+    self.acc_bias += bias_delta
+    # (rospy's throttled loggers take a single message on Indigo, so only format the
+    # bias array when debug output is actually enabled)
+    if logging.getLogger('rosout').isEnabledFor(logging.DEBUG):
+      rospy.logdebug_throttle(1.0, "bias: " + str(self.acc_bias))
 
   # Main node execution function
   def run(self):
@@ -158,36 +386,32 @@ class KalmanFilter:
 
     # Initialize Kalman filter
     self.P_lin = np.diag([1.,0.,1.,0.])*pow(self.initial_position_uncertainty,2)
-    self.Q_lin = self.G_lin.dot(Q[:2,:2]).dot(self.G_lin.T)
+    self.Q_acc = Q[:2,:2].copy() # planar accelerometer covariance
     self.P_ang = pow(self.initial_orientation_uncertainty,2)
     self.Q_ang = self.G_ang*Q[5,5]*self.G_ang
-    self.R_lin = np.eye(2)*pow(self.camera_position_error,2)
+    self.R_lin = pow(self.camera_position_error,2) # per axis: R_lin*eye(2)
     self.R_ang = pow(self.camera_orientation_error,2)
-    self.acc_bias = mu[:2]
+    self.acc_bias = mu[:2].copy() # own buffer, updated in place by updateAccelBias
     self.gyro_bias = mu[5]
-    self.x_lin = np.array([self.z.translation.x, self.z.translation.y])
+    self.xv = np.array([self.z.translation.x, 0., self.z.translation.y, 0.]) # [x, vx, y, vy]
     self.z_position = 0.
-    self.v_lin = np.array([0.,0.])
-    self.psi = 2*np.arccos(self.z.rotation.w)*np.sign(self.z.rotation.z) # Assume we have a quaternion with vertical axis
+    self.psi = _heading(self.z.rotation) # Assume we have a quaternion with vertical axis
 
     # Run Kalman filter
     while not rospy.is_shutdown() and not self.needs_to_calibrate:
-      # Obtain IMU measurement
-      rospy.wait_for_service('last_imu')
-      try:
-        get_imu = rospy.ServiceProxy('last_imu', ImuSrv)
-        self.u = get_imu()
-        # update bias estimate for accelerometer IMU update this time step: 1, trying aga
+      # Obtain IMU measurement (freshest sample from the poll thread)
+      u = self.latestImu()
+      if u is not None and u is not self.u:
+        self.u = u
+        # update bias estimate for accelerometer
         self.updateAccelBias()
-      except rospy.ServiceException, e:
-        #print "Service call to IMU Server failed: %s"%e
-        print "No IMU update this time step"
+      else:
+        rospy.logwarn_throttle(1.0, "No IMU update this time step")
         # Only runs if self.u is unitialized
-        while not self.u:
-            try:
-                self.u = get_imu()
-            except:
-                print 'Trying to initialize'
+        if not self.u:
+          rospy.loginfo_throttle(1.0, "Trying to initialize")
+          self.rate.sleep()
+          continue
         # Assume previous measured u (Zero-Order Hold)
 
       # Perform time and measurement updates as appropriate
@@ -196,22 +420,20 @@ class KalmanFilter:
         self.measurementUpdate(self.z)
 
       # Publish state estimate in topic
-      state = Transform()
-      state.translation.x = self.x_lin[0]
-      state.translation.y = self.x_lin[1]
+      state = self.state_msg
+      state.translation.x = self.xv[0]
+      state.translation.y = self.xv[2]
       state.translation.z = self.z_position
-      state.rotation.z = np.sin(self.psi/2)
-      state.rotation.w = np.cos(self.psi/2) # Quaternion form
+      state.rotation.z = math.sin(self.psi*0.5)
+      state.rotation.w = math.cos(self.psi*0.5) # Quaternion form
       self.state_pub.publish(state)
-      self.psi_pub.publish(self.psi)
-
-      state_tf = TFMessage()
-      state_tf.transforms = [TransformStamped()]
-      state_tf.transforms[0].header.seq = counter
-      state_tf.transforms[0].header.frame_id = self.origin_tag
-      state_tf.transforms[0].child_frame_id = self.mname
-      state_tf.transforms[0].transform = state
-      self.state_pub_tf.publish(state_tf)
+      self.psi_msg.data = self.psi
+      self.psi_pub.publish(self.psi_msg)
+
+      state_tf = self.tf_msg.transforms[0]
+      state_tf.header.seq = counter
+      state_tf.header.frame_id = self.origin_tag
+      self.state_pub_tf.publish(self.tf_msg)
 
       counter = counter + 1
       # Finish cycle and loop